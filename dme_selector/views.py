@@ -1,23 +1,43 @@
 import os
-import json
-from django.http import JsonResponse
+import hashlib
+import logging
+import asyncio
+import threading
+from collections import OrderedDict
+import orjson
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from langchain_openai import ChatOpenAI
-from langchain.prompts import PromptTemplate
+from langchain_core.messages import HumanMessage, SystemMessage
 from dotenv import load_dotenv
 
+logger = logging.getLogger(__name__)
+
 # Load environment variables
 load_dotenv()
 openai_key = os.getenv("OPENAI_API_KEY")
 os.environ["OPENAI_API_KEY"] = openai_key
 
+# Partner data file
+DME_PATH = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../data/dme_partners.json"))
+
 # Initialize model
-llm_model = ChatOpenAI(model="gpt-4o", temperature=0.3)
+# JSON mode guarantees a bare JSON object, so no markdown fences to strip
+llm_model = ChatOpenAI(
+    model="gpt-4o",
+    temperature=0.3,
+    model_kwargs={"response_format": {"type": "json_object"}},
+)
+
+# Columns of the partner table sent to the LLM; also quoted in the instructions
+PARTNER_TABLE_HEADER = "partner_id|partner_name|partner_rating|previous_delivery_satisfaction_rating|contract_types|fulfilled_hcpcs|fulfilled_products"
 
-# Prompt template
-template = """
-You are a DME logistics expert. Given the medical order and the list of DME partners,
-evaluate each partner and produce an output.
+# System instructions — kept byte-identical across requests so the provider
+# can cache the prompt prefix; per-request data goes in the human message
+instructions = """You are a DME logistics expert. You will receive one or more numbered requests
+("Request 1:", "Request 2:", ...), each with its own medical order and list of DME partners.
+Evaluate each request independently, using only that request's partners, and produce an output.
 
 Selection Logic:
 - The best partner must be able to fulfill all the requested products. If not fulfilled, don't recommend a best partner.
@@ -25,155 +45,408 @@ Selection Logic:
 - If there is a best partner, do NOT suggest split_delivery.
 - Use partner_rating, previous_delivery_satisfaction_rating, and contract quality as tie-breakers.
 - If no single partner can fulfill all products, provide a 'split_delivery' — a set of partners that collectively fulfill the full order.
-- Do not consider the 'status' field.
+
+DME Partners Format:
+The DME partners are given as a pipe-delimited table whose first row is the header:
+""" + PARTNER_TABLE_HEADER + """
+- "contract_types" lists the partner's contract types (exclusive, preferred, standard, non-exclusive), separated by ";". Use it to judge contract quality.
+- "fulfilled_hcpcs" and "fulfilled_products" list the requested HCPCS codes and product names that the partner's catalog covers, separated by ";".
+- A partner fulfills all requested products only if "fulfilled_products" contains every product name in the medical order.
 
 Output Format:
-Respond ONLY in JSON with the following format:
-
-{{
-  "best_partner": {{
-    "partner_id": "<ID>",
-    "partner_name": "<Name>",
-    "summary": "<Short explanation of the selection made>"
-  }},
-  "alternatives": [
-    {{
-      "partner_id": "<ID>",
-      "partner_name": "<Name>",
+Respond ONLY in JSON with the following format, with exactly one entry in "results" per request:
+
+{
+  "results": [
+    {
+      "request_index": <Request number>,
+      "best_partner": {
+        "partner_id": "<ID>",
+        "partner_name": "<Name>",
+        "summary": "<Short explanation of the selection made>"
+      },
+      "alternatives": [
+        {
+          "partner_id": "<ID>",
+          "partner_name": "<Name>",
+          "summary": "<Short explanation of the selection made>"
+        }
+      ],
+      "split_delivery": [
+        {
+          "partner_id": "<ID>",
+          "partner_name": "<Name>",
+          "fulfilled_products": ["<Product Name 1>", "<Product Name 2>"]
+        }
+      ],
       "summary": "<Short explanation of the selection made>"
-    }}
-  ],
-  "split_delivery": [
-    {{
-      "partner_id": "<ID>",
-      "partner_name": "<Name>",
-      "fulfilled_products": ["<Product Name 1>", "<Product Name 2>"]
-    }}
-  ],
-  "summary": "<Short explanation of the selection made>"
-}}
+    }
+  ]
+}
 
 Instructions:
+- "request_index" must be the number of the request the entry answers.
 - "summary" should be a one-line explanation describing why the selected partner or split was chosen.
 - "best_partner" must fulfill all requested products.
 - "alternatives" are backup partners that also fulfill all products but scored lower.
 - Use "split_delivery" ONLY if no single partner can fulfill the full order — include product names each can supply.
 - All output must be strictly in JSON. Do not explain outside the JSON block.
+"""
 
-Medical Order:
-{order}
+system_message = SystemMessage(content=instructions)
+
+# Parsed partner data, reloaded only when the file on disk changes
+_partners_cache = {"key": None, "by_state": None, "by_id": None}
+_partners_lock = threading.Lock()
+
+# Verified LLM selections keyed on the selection-relevant parts of the order and partner set
+LLM_CACHE_SIZE = 4096
+_llm_cache = OrderedDict()
+_llm_cache_lock = threading.Lock()
 
-DME Partners:
-{partners}
-"""
 
-prompt = PromptTemplate.from_template(template)
+def load_dme_partners(dme_path):
+    st = os.stat(dme_path)
+    key = (dme_path, st.st_mtime_ns, st.st_size)
+    with _partners_lock:
+        if key != _partners_cache["key"]:
+            with open(dme_path, "rb") as f:
+                dme_partners = orjson.loads(f.read())
 
+            # Index partners by state so the per-request filter only sees candidates
+            by_state = {}
+            for partner in dme_partners:
+                index_partner_catalog(partner)
+                by_state.setdefault(partner.get("state"), []).append(partner)
 
-def partner_matches_all_products(order_products, partner_catalog):
-    for product in order_products:
-        required_hcpcs = product.get("hcpcs_code", "").strip().upper()
-        required_option = product.get("protocol_step_option", "").strip().lower()
+            _partners_cache["by_state"] = by_state
+            _partners_cache["by_id"] = {p["partner_id"]: p for p in dme_partners}
+            _partners_cache["key"] = key
 
-        match_found = any(
-            p.get("hcpcs_code", "").strip().upper() == required_hcpcs or
-            p.get("protocol_step_option", "").strip().lower() == required_option
-            for p in partner_catalog
+            # Entries for the old catalog can no longer be hit; free them
+            with _llm_cache_lock:
+                _llm_cache.clear()
+        # (mtime_ns, size) identifies the catalog version the indexes came from
+        return _partners_cache["by_state"], _partners_cache["by_id"], key[1:]
+
+
+def index_partner_catalog(partner):
+    # Normalized lookup sets, built once per partner when the file is loaded
+    catalog = partner.get("product_catalog", [])
+    partner["_hcpcs_set"] = frozenset(p.get("hcpcs_code", "").strip().upper() for p in catalog)
+    partner["_product_names"] = frozenset(p.get("product_name", "").strip() for p in catalog)
+
+
+def order_projection(order_products):
+    # The only order data the LLM sees and the response cache is keyed on:
+    # one (hcpcs, option, product_name) tuple per distinct line, no patient data
+    return sorted({
+        (
+            p.get("hcpcs_code", "").strip().upper(),
+            p.get("protocol_step_option", "").strip().lower(),
+            p.get("product_name", "").strip(),
         )
-        if not match_found:
+        for p in order_products
+    })
+
+
+def order_message(state, order_lines):
+    return orjson.dumps({
+        "state": state,
+        "products": [
+            {"hcpcs_code": hcpcs, "protocol_step_option": option, "product_name": name}
+            for hcpcs, option, name in order_lines
+        ],
+    }).decode()
+
+
+def fulfills_all_products(partner, requested_product_names):
+    # Same test the LLM result verification applies
+    return requested_product_names.issubset(partner["_product_names"])
+
+
+def llm_cache_key(order_lines, state, eligible_partners, catalog_version):
+    # Covers everything the prompt is built from, so orders that differ only in
+    # patient or practice details, line ordering, or repeated lines share an entry
+    payload = {
+        "products": order_lines,
+        "state": state,
+        "partner_ids": sorted(p["partner_id"] for p in eligible_partners),
+        # A miss still in flight when the file reloads stores under the old version
+        "catalog_version": catalog_version,
+    }
+    return hashlib.sha256(orjson.dumps(payload)).hexdigest()
+
+
+def parse_llm_results(content, count):
+    """Map request_index to result object from a reply to `count` numbered requests.
+
+    Entries with a missing or out-of-range request_index are left out.
+    """
+    reply = orjson.loads(content)
+    results = reply.get("results") if isinstance(reply, dict) else None
+    if not isinstance(results, list):
+        raise ValueError("LLM reply has no results list")
+    by_index = {}
+    for result in results:
+        if isinstance(result, dict) and result.get("request_index") in range(1, count + 1):
+            by_index[result.pop("request_index")] = result
+    return by_index
+
+
+async def call_llm(human_contents):
+    # Each human_content holds only an order projection and partner table (see
+    # order_projection), so a batched completion never sees patient details
+    blocks = "\n\n---\n\n".join(
+        f"Request {i}:\n{human_content}" for i, human_content in enumerate(human_contents, 1)
+    )
+    reply = await llm_model.ainvoke([system_message, HumanMessage(content=blocks)])
+    return parse_llm_results(reply.content, len(human_contents))
+
+
+class LLMBatcher:
+    """Coalesces orders that arrive within a short window into one LLM call.
+
+    The system instructions are sent once per batch instead of once per
+    order. A batch is flushed when it reaches max_batch_size or when
+    max_wait seconds have passed since its first order arrived.
+
+    Batching only pays off on a long-lived event loop, i.e. when served over
+    ASGI; under WSGI every request runs on its own short-lived loop.
+    """
+
+    def __init__(self, max_batch_size=8, max_wait=0.05):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        # (queue, collector task) per event loop; the task drops its own entry
+        # when the loop shuts down, so nothing outlives the loop
+        self._collectors = {}
+
+    async def submit(self, human_content):
+        loop = asyncio.get_running_loop()
+        collector = self._collectors.get(loop)
+        if collector is None:
+            pending = asyncio.Queue()
+            collector = self._collectors[loop] = (pending, loop.create_task(self._collect(loop, pending)))
+        future = loop.create_future()
+        collector[0].put_nowait((human_content, future))
+        return await future
+
+    async def _collect(self, loop, pending):
+        flushing = set()
+        try:
+            while True:
+                batch = [await pending.get()]
+                deadline = loop.time() + self.max_wait
+                while len(batch) < self.max_batch_size:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(pending.get(), remaining))
+                    except asyncio.TimeoutError:
+                        break
+                task = loop.create_task(self._flush(batch))
+                flushing.add(task)
+                task.add_done_callback(flushing.discard)
+        finally:
+            self._collectors.pop(loop, None)
+
+    async def _flush(self, batch):
+        try:
+            results = await call_llm([human_content for human_content, _ in batch])
+        except ValueError as e:
+            # Unusable reply (orjson.JSONDecodeError is a ValueError): worth retrying per order
+            if len(batch) == 1:
+                self._fail(batch, e)
+                return
+            logger.warning("Batched LLM reply for %d orders was unusable (%s); retrying one by one", len(batch), e)
+            results = {}
+        except Exception as e:
+            # Rate limits, timeouts, auth errors: retrying per order would only add load
+            self._fail(batch, e)
+            return
+
+        missing = []
+        for i, (human_content, future) in enumerate(batch, 1):
+            if i not in results:
+                missing.append((human_content, future))
+            elif not future.done():
+                future.set_result(results[i])
+        if not missing:
+            return
+
+        if len(batch) == 1:
+            self._fail(batch, ValueError("LLM reply has no result for the request"))
+        else:
+            # Fall back to one call per order for anything the batch didn't answer
+            await asyncio.gather(*(self._flush([item]) for item in missing))
+
+    @staticmethod
+    def _fail(batch, error):
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(error)
+
+
+_llm_batcher = LLMBatcher()
+
+
+def verify_selection(result_json, requested_product_names, partners_by_id, eligible_ids):
+    """Drop any selection in the LLM result that the partner data does not back up.
+
+    Only partners in eligible_ids, the request's own eligible set, are accepted.
+    Raises ValueError if the result is not in the expected format.
+    """
+    best = result_json.get("best_partner")
+    if best and not (isinstance(best, dict) and "partner_id" in best):
+        raise ValueError("LLM reply has a best_partner without partner_id")
+    alternatives = result_json.get("alternatives") or []
+    if not isinstance(alternatives, list) or not all(isinstance(a, dict) and "partner_id" in a for a in alternatives):
+        raise ValueError("LLM reply has malformed alternatives")
+    split_delivery = result_json.get("split_delivery") or []
+    if not isinstance(split_delivery, list) or not all(
+        isinstance(part, dict) and isinstance(part.get("fulfilled_products", []), list) for part in split_delivery
+    ):
+        raise ValueError("LLM reply has malformed split_delivery")
+
+    def fulfills_order(partner_id):
+        if partner_id not in eligible_ids:
             return False
-    return True
+        return fulfills_all_products(partners_by_id[partner_id], requested_product_names)
+
+    # Verify best partner
+    if best and not fulfills_order(best["partner_id"]):
+        result_json["best_partner"] = None
+
+    # Verify alternatives
+    result_json["alternatives"] = [alt for alt in alternatives if fulfills_order(alt["partner_id"])]
+
+    # Verify split delivery; never kept alongside a best_partner
+    if split_delivery:
+        if result_json.get("best_partner") or any(part.get("partner_id") not in eligible_ids for part in split_delivery):
+            result_json["split_delivery"] = []
+        else:
+            combined_products = set()
+            for part in split_delivery:
+                combined_products.update(part.get("fulfilled_products", []))
+            if not requested_product_names.issubset(combined_products):
+                result_json["split_delivery"] = []
+
+    return result_json
+
+
+async def invoke_llm_cached(cache_key, human_content, batch, verify):
+    # Only verified selections are cached, so a bad reply is never replayed
+    with _llm_cache_lock:
+        result_json = _llm_cache.get(cache_key)
+        if result_json is not None:
+            _llm_cache.move_to_end(cache_key)
+            return result_json
+
+    # Wait outside the lock so concurrent misses can share a batch
+    if batch:
+        result_json = await _llm_batcher.submit(human_content)
+    else:
+        result_json = (await call_llm([human_content])).get(1)
+        if result_json is None:
+            raise ValueError("LLM reply has no result for the request")
+    result_json = verify(result_json)
+
+    with _llm_cache_lock:
+        _llm_cache[cache_key] = result_json
+        _llm_cache.move_to_end(cache_key)
+        while len(_llm_cache) > LLM_CACHE_SIZE:
+            _llm_cache.popitem(last=False)
+    return result_json
+
+
+def orjson_response(data, status=200):
+    # Same wire format as JsonResponse, serialized by orjson instead of DjangoJSONEncoder
+    return HttpResponse(orjson.dumps(data), content_type="application/json", status=status)
+
+
+def partners_table(eligible_partners, order_lines, requested_product_names):
+    # One row per partner with only the columns the selection logic refers to
+    requested_hcpcs = {hcpcs for hcpcs, _, _ in order_lines}
+    rows = [PARTNER_TABLE_HEADER]
+    for p in eligible_partners:
+        contract_types = ";".join(sorted({c.get("type", "") for c in p.get("contracts", [])}))
+        fulfilled_hcpcs = ";".join(sorted(p["_hcpcs_set"] & requested_hcpcs))
+        fulfilled_products = ";".join(sorted(p["_product_names"] & requested_product_names))
+        rows.append(
+            f"{p['partner_id']}|{p['partner_name']}|{p.get('partner_rating', '')}|"
+            f"{p.get('previous_delivery_satisfaction_rating', '')}|{contract_types}|"
+            f"{fulfilled_hcpcs}|{fulfilled_products}"
+        )
+    return "\n".join(rows)
 
 
 @csrf_exempt
-def select_dme_partner(request):
+async def select_dme_partner(request):
     if request.method != 'POST':
-        return JsonResponse({"error": "POST required"}, status=405)
+        return orjson_response({"error": "POST required"}, status=405)
 
     try:
-        body = json.loads(request.body)
+        body = orjson.loads(request.body)
         order_json = body["order"]
         state = order_json["practice_details"]["address"]["address_state"]
         order_products = order_json["details"][0]["products"]
 
+        # Reduce the order once to the fields partner selection depends on
+        order_lines = order_projection(order_products)
+        requested_product_names = {name for _, _, name in order_lines}
+
         # Load partners
-        base_dir = os.path.dirname(os.path.abspath(__file__))
-        dme_path = os.path.normpath(os.path.join(base_dir, "../data/dme_partners.json"))
-        with open(dme_path, "r") as f:
-            dme_partners = json.load(f)
+        partners_by_state, partners_by_id, catalog_version = load_dme_partners(DME_PATH)
 
         # Filter based on state and payor
         eligible_partners = []
-        for partner in dme_partners:
-            if partner.get("state") != state:
-                continue
+        for partner in partners_by_state.get(state, []):
             if not partner.get("contracted_payor_status", False):
                 continue
             eligible_partners.append(partner)
 
         if not eligible_partners:
-            return JsonResponse({"error": "No eligible DME partners found for the patient's state and payor status."}, status=404)
+            return orjson_response({"error": "No eligible DME partners found for the patient's state and payor status."}, status=404)
 
-        # Format the prompt
-        formatted_prompt = prompt.format(
-            order=json.dumps(order_json, indent=2),
-            partners=json.dumps(eligible_partners, indent=2)
-        )
+        # Only one partner can fulfill the whole order: nothing to rank, skip the LLM
+        fulfilling_partners = [p for p in eligible_partners if fulfills_all_products(p, requested_product_names)]
+        if len(fulfilling_partners) == 1:
+            partner = fulfilling_partners[0]
+            summary = "Only eligible partner in state that fulfills all products."
+            result_json = {
+                "best_partner": {
+                    "partner_id": partner["partner_id"],
+                    "partner_name": partner["partner_name"],
+                    "summary": summary,
+                },
+                "alternatives": [],
+                "split_delivery": [],
+                "summary": summary,
+            }
+            return orjson_response(result_json)
 
-        # Get LLM response
-        response = llm_model.invoke(formatted_prompt)
-        content = response.content.strip()
-
-        # Clean LLM output if it's wrapped in markdown
-        if content.startswith("```"):
-            content = content.strip("`").strip()
-            if content.startswith("json\n"):
-                content = content[len("json\n"):]
-            elif content.startswith("json\r\n"):
-                content = content[len("json\r\n"):]
-
-        result_json = json.loads(content)
-
-        # ✅ Post-processing: verify best_partner and split_delivery
-        def product_names_from_order(order_products):
-            return set(p.get("product_name", "").strip() for p in order_products)
-
-        def product_names_from_partner(partner):
-            return set(p.get("product_name", "").strip() for p in partner.get("product_catalog", []))
-
-        requested_product_names = product_names_from_order(order_products)
-
-        # Verify best partner
-        if result_json.get("best_partner"):
-            best_id = result_json["best_partner"]["partner_id"]
-            best_partner = next((p for p in dme_partners if p["partner_id"] == best_id), None)
-            if not best_partner or not requested_product_names.issubset(product_names_from_partner(best_partner)):
-                result_json["best_partner"] = None
-
-        # Verify alternatives
-        filtered_alternatives = []
-        for alt in result_json.get("alternatives", []):
-            alt_id = alt["partner_id"]
-            alt_partner = next((p for p in dme_partners if p["partner_id"] == alt_id), None)
-            if alt_partner and requested_product_names.issubset(product_names_from_partner(alt_partner)):
-                filtered_alternatives.append(alt)
-        result_json["alternatives"] = filtered_alternatives
-
-        # Verify split delivery
-        if result_json.get("split_delivery"):
-            combined_products = set()
-            for part in result_json["split_delivery"]:
-                fulfilled = set(part.get("fulfilled_products", []))
-                combined_products.update(fulfilled)
-            if not requested_product_names.issubset(combined_products):
-                result_json["split_delivery"] = []
-            # Also: if best_partner exists, clear split_delivery
-            if result_json.get("best_partner"):
-                result_json["split_delivery"] = []
+        # Build the per-request message
+        # Built only from the order projection, never the raw order, so a cached or
+        # batched reply cannot carry another patient's details
+        order_str = order_message(state, order_lines)
+        partners_str = partners_table(eligible_partners, order_lines, requested_product_names)
+        human_content = f"Medical Order:\n{order_str}\n\nDME Partners:\n```\n{partners_str}\n```"
 
-        return JsonResponse(result_json)
+        # Get LLM response
+        cache_key = llm_cache_key(order_lines, state, eligible_partners, catalog_version)
+        result_json = await invoke_llm_cached(
+            cache_key,
+            human_content,
+            # Batch only on a long-lived ASGI event loop
+            batch=isinstance(request, ASGIRequest),
+            verify=lambda result: verify_selection(
+                result, requested_product_names, partners_by_id, {p["partner_id"] for p in eligible_partners}
+            ),
+        )
+        return orjson_response(result_json)
 
     except Exception as e:
-        import traceback
-        traceback.print_exc()
-        return JsonResponse({"error": f"Invalid JSON from LLM: {str(e)}"}, status=500)
\ No newline at end of file
+        logger.exception("DME partner selection failed")
+        return orjson_response({"error": f"Invalid JSON from LLM: {str(e)}"}, status=500)
\ No newline at end of file
@@ -3,6 +3,10 @@ ASGI config for src project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Serve with ``uvicorn src.asgi:application``. All requests then share one
+long-lived event loop, which lets dme_selector batch concurrent LLM calls;
+under WSGI (including ``runserver``) each request calls the LLM on its own.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 """